@@ -174,6 +174,20 @@ class UtilityMigrationTestCase(test.NoDBTestCase):
         new_xml = xml.replace("127.0.0.1", "127.0.0.100")
         self.assertThat(res, matchers.XMLMatches(new_xml))
 
+    def test_update_serial_xml_without_addr(self):
+        data = objects.LibvirtLiveMigrateData()
+        xml = """<domain>
+  <devices>
+    <serial type="tcp">
+      <source host="127.0.0.1" service="2000"/>
+      <target type="serial" port="0"/>
+    </serial>
+  </devices>
+</domain>"""
+        doc = etree.fromstring(xml)
+        res = etree.tostring(migration._update_serial_xml(doc, data))
+        self.assertThat(res, matchers.XMLMatches(xml))
+
     def test_update_graphics(self):
         data = objects.LibvirtLiveMigrateData(
             graphics_listen_addr_vnc='127.0.0.100',
@@ -194,6 +208,37 @@ class UtilityMigrationTestCase(test.NoDBTestCase):
         new_xml = new_xml.replace("127.0.0.2", "127.0.0.200")
         self.assertThat(res, matchers.XMLMatches(new_xml))
 
+    def test_update_graphics_spice_only(self):
+        data = objects.LibvirtLiveMigrateData(
+            graphics_listen_addr_spice='127.0.0.200')
+        xml = """<domain>
+  <devices>
+    <graphics type="vnc" listen="127.0.0.1">
+      <listen type="address" address="127.0.0.1"/>
+    </graphics>
+    <graphics type="spice" listen="127.0.0.2">
+      <listen type="address" address="127.0.0.2"/>
+    </graphics>
+  </devices>
+</domain>"""
+        doc = etree.fromstring(xml)
+        res = etree.tostring(migration._update_graphics_xml(doc, data))
+        new_xml = xml.replace("127.0.0.2", "127.0.0.200")
+        self.assertThat(res, matchers.XMLMatches(new_xml))
+
+    def test_update_graphics_without_addrs(self):
+        data = objects.LibvirtLiveMigrateData()
+        xml = """<domain>
+  <devices>
+    <graphics type="vnc">
+      <listen type="address" address="127.0.0.1"/>
+    </graphics>
+  </devices>
+</domain>"""
+        doc = etree.fromstring(xml)
+        res = etree.tostring(migration._update_graphics_xml(doc, data))
+        self.assertThat(res, matchers.XMLMatches(xml))
+
     def test_update_volume_xml(self):
         connection_info = {
             'driver_volume_type': 'iscsi',
@@ -243,6 +288,146 @@ class UtilityMigrationTestCase(test.NoDBTestCase):
                               'ip-1.2.3.4:3260-iqn.cde.67890.opst-lun-Z')
         self.assertThat(res, matchers.XMLMatches(new_xml))
 
+    def test_update_volume_xml_additional_items(self):
+        connection_info = {
+            'driver_volume_type': 'iscsi',
+            'serial': '58a84f6d-3f0c-4e19-a0af-eb657b790657',
+            'data': {
+                'device_path':
+                '/dev/disk/by-path/ip-1.2.3.4:3260-iqn.cde.67890.opst-lun-Z'}}
+        bdm = objects.LibvirtLiveMigrateBDMInfo(
+            serial='58a84f6d-3f0c-4e19-a0af-eb657b790657',
+            bus='virtio', type='disk', dev='vdb',
+            connection_info=connection_info)
+        data = objects.LibvirtLiveMigrateData(
+            target_connect_addr='127.0.0.1',
+            bdms=[bdm],
+            block_migration=False)
+        xml = """<domain>
+ <devices>
+   <disk type='block' device='disk'>
+     <driver name='qemu' type='raw' cache='none'/>
+     <source dev='/dev/disk/by-path/ip-1.2.3.4:3260-iqn.abc.12345.opst-lun-X'/>
+     <target bus='virtio' dev='vdb'/>
+     <serial>58a84f6d-3f0c-4e19-a0af-eb657b790657</serial>
+     <address type='pci' domain='0x0' bus='0x0' slot='0x04' function='0x0'/>
+   </disk>
+ </devices>
+</domain>"""
+        conf = vconfig.LibvirtConfigGuestDisk()
+        conf.source_device = bdm.type
+        conf.driver_name = "qemu"
+        conf.driver_format = "raw"
+        conf.driver_cache = "none"
+        conf.target_dev = bdm.dev
+        conf.target_bus = bdm.bus
+        conf.serial = bdm.connection_info.get('serial')
+        conf.source_type = "block"
+        conf.source_path = bdm.connection_info['data'].get('device_path')
+        conf.disk_total_bytes_sec = 2048
+
+        get_volume_config = mock.MagicMock(return_value=conf)
+        doc = etree.fromstring(xml)
+        res = etree.tostring(migration._update_volume_xml(
+            doc, data, get_volume_config))
+        # Items only known by the destination are appended to the disk
+        new_xml = xml.replace('ip-1.2.3.4:3260-iqn.abc.12345.opst-lun-X',
+                              'ip-1.2.3.4:3260-iqn.cde.67890.opst-lun-Z')
+        new_xml = new_xml.replace(
+            "</disk>",
+            "<iotune><total_bytes_sec>2048</total_bytes_sec></iotune></disk>")
+        self.assertThat(res, matchers.XMLMatches(new_xml))
+
+    def test_update_volume_xml_multiple_disks(self):
+        serial_a = '58a84f6d-3f0c-4e19-a0af-eb657b790657'
+        # The quotes check that the serial is bound as an XPath variable
+        serial_b = 'vol-"b\''
+
+        def fake_bdm(serial, dev, path):
+            connection_info = {
+                'driver_volume_type': 'iscsi',
+                'serial': serial,
+                'data': {'device_path': path}}
+            return objects.LibvirtLiveMigrateBDMInfo(
+                serial=serial, bus='virtio', type='disk', dev=dev,
+                connection_info=connection_info)
+
+        def fake_volume_config(connection_info, disk_info):
+            conf = vconfig.LibvirtConfigGuestDisk()
+            conf.source_device = disk_info['type']
+            conf.driver_name = "qemu"
+            conf.driver_format = "raw"
+            conf.driver_cache = "none"
+            conf.target_dev = disk_info['dev']
+            conf.target_bus = disk_info['bus']
+            conf.serial = connection_info['serial']
+            conf.source_type = "block"
+            conf.source_path = connection_info['data']['device_path']
+            return conf
+
+        bdm_a = fake_bdm(serial_a, 'vdb', '/dev/disk/by-path/new-a')
+        bdm_b = fake_bdm(serial_b, 'vdc', '/dev/disk/by-path/new-b')
+        # The BDMs are listed in the opposite order to the guest disks
+        data = objects.LibvirtLiveMigrateData(
+            target_connect_addr='127.0.0.1',
+            bdms=[bdm_b, bdm_a],
+            block_migration=False)
+        xml = """<domain>
+ <devices>
+   <disk type='file' device='disk'>
+     <driver name='qemu' type='qcow2' cache='none'/>
+     <source file='/var/lib/nova/instances/fake/disk'/>
+     <target bus='virtio' dev='vda'/>
+   </disk>
+   <disk type='block' device='disk'>
+     <driver name='qemu' type='raw' cache='none'/>
+     <source dev='/dev/disk/by-path/old-a'/>
+     <target bus='virtio' dev='vdb'/>
+     <serial>%(serial_a)s</serial>
+     <address type='pci' domain='0x0' bus='0x0' slot='0x04' function='0x0'/>
+   </disk>
+   <disk type='block' device='disk'>
+     <driver name='qemu' type='raw' cache='none'/>
+     <source dev='/dev/disk/by-path/old-b'/>
+     <target bus='virtio' dev='vdc'/>
+     <serial>%(serial_b)s</serial>
+     <address type='pci' domain='0x0' bus='0x0' slot='0x05' function='0x0'/>
+   </disk>
+ </devices>
+</domain>""" % {'serial_a': serial_a, 'serial_b': serial_b}
+
+        get_volume_config = mock.MagicMock(side_effect=fake_volume_config)
+        doc = etree.fromstring(xml)
+        res = etree.tostring(migration._update_volume_xml(
+            doc, data, get_volume_config))
+        new_xml = xml.replace('/dev/disk/by-path/old-a',
+                              '/dev/disk/by-path/new-a')
+        new_xml = new_xml.replace('/dev/disk/by-path/old-b',
+                                  '/dev/disk/by-path/new-b')
+        self.assertThat(res, matchers.XMLMatches(new_xml))
+        self.assertEqual(2, get_volume_config.call_count)
+        get_volume_config.assert_has_calls([
+            mock.call(bdm_b.connection_info, bdm_b.as_disk_info()),
+            mock.call(bdm_a.connection_info, bdm_a.as_disk_info())],
+            any_order=True)
+
+    def test_update_volume_xml_no_bdms(self):
+        data = objects.LibvirtLiveMigrateData(bdms=[])
+        xml = """<domain>
+ <devices>
+   <disk type='file' device='disk'>
+     <source file='/var/lib/nova/instances/fake/disk'/>
+     <target bus='virtio' dev='vda'/>
+   </disk>
+ </devices>
+</domain>"""
+        get_volume_config = mock.MagicMock()
+        doc = etree.fromstring(xml)
+        res = etree.tostring(migration._update_volume_xml(
+            doc, data, get_volume_config))
+        self.assertThat(res, matchers.XMLMatches(xml))
+        self.assertFalse(get_volume_config.called)
+
     def test_update_perf_events_xml(self):
         data = objects.LibvirtLiveMigrateData(
             supported_perf_events=['cmt'])
@@ -525,6 +710,20 @@ class MigrationMonitorTestCase(test.NoDBTestCase):
         self.assertEqual(newdt, 200)
         mock_dt.assert_called_once_with(200)
 
+    @mock.patch.object(libvirt_guest.Guest,
+                       "migrate_configure_max_downtime")
+    def test_live_migration_update_downtime_on_marker(self, mock_dt):
+        steps = [
+            (9000, 50),
+            (18000, 200),
+        ]
+        # We shouldn't move to the second step until its time has passed
+        newdt = migration.update_downtime(self.guest, self.instance,
+                                          50, steps, 18000)
+
+        self.assertEqual(newdt, 50)
+        self.assertFalse(mock_dt.called)
+
     @mock.patch.object(libvirt_guest.Guest,
                        "migrate_configure_max_downtime")
     def test_live_migration_update_downtime_err(self, mock_dt):
@@ -570,6 +769,29 @@ class MigrationMonitorTestCase(test.NoDBTestCase):
         mock_msave.assert_called_once_with()
         mock_isave.assert_called_once_with()
 
+    @mock.patch.object(objects.Instance, "save")
+    @mock.patch.object(objects.Migration, "save")
+    def test_live_migration_save_stats_same_progress(self, mock_msave,
+                                                     mock_isave):
+        mig = objects.Migration()
+        self.instance.progress = 25
+        self.instance.obj_reset_changes()
+
+        info = libvirt_guest.JobInfo(
+            memory_total=1 * units.Gi,
+            memory_processed=5 * units.Gi,
+            memory_remaining=500 * units.Mi,
+            disk_total=15 * units.Gi,
+            disk_processed=10 * units.Gi,
+            disk_remaining=14 * units.Gi)
+
+        migration.save_stats(self.instance, mig, info, 75)
+
+        self.assertEqual(self.instance.progress, 25)
+
+        mock_msave.assert_called_once_with()
+        self.assertFalse(mock_isave.called)
+
     @mock.patch.object(libvirt_guest.Guest, "migrate_start_postcopy")
     @mock.patch.object(libvirt_guest.Guest, "pause")
     def test_live_migration_run_tasks_empty_tasks(self, mock_pause,
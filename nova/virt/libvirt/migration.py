@@ -17,6 +17,7 @@
 
 """
 
+import bisect
 from collections import deque
 
 from lxml import etree
@@ -34,16 +35,32 @@ CONF = nova.conf.CONF
 # etc in Ocata.
 libvirt = None
 
+# XPath expressions used to rewrite the guest XML on every live migration,
+# compiled once here rather than parsed again by each findall() call.
+_GRAPHICS_XPATH = etree.XPath('./devices/graphics')
+_LISTEN_XPATH = etree.XPath('./listen[1]')
+_TARGET_XPATH = etree.XPath('./target[1]')
+_SERIAL_CONSOLE_XPATH = etree.XPath(
+    "./devices/*[(self::serial or self::console) and @type='tcp']/source")
+_DISK_BY_SERIAL_XPATH = etree.XPath('./devices/disk[serial=$serial]')
+_PERF_XPATH = etree.XPath('./perf')
+
+# Parser for the migratable guest XML, configured once instead of on
+# every call. Blank text is kept so the document is returned with its
+# original formatting.
+_PARSER = etree.XMLParser(resolve_entities=False)
+
 
 def graphics_listen_addrs(migrate_data):
     """Returns listen addresses of vnc/spice from a LibvirtLiveMigrateData"""
-    listen_addrs = None
-    if (migrate_data.obj_attr_is_set('graphics_listen_addr_vnc')
-        or migrate_data.obj_attr_is_set('graphics_listen_addr_spice')):
-        listen_addrs = {'vnc': None, 'spice': None}
-    if migrate_data.obj_attr_is_set('graphics_listen_addr_vnc'):
+    has_vnc = migrate_data.obj_attr_is_set('graphics_listen_addr_vnc')
+    has_spice = migrate_data.obj_attr_is_set('graphics_listen_addr_spice')
+    if not (has_vnc or has_spice):
+        return None
+    listen_addrs = {'vnc': None, 'spice': None}
+    if has_vnc:
         listen_addrs['vnc'] = str(migrate_data.graphics_listen_addr_vnc)
-    if migrate_data.obj_attr_is_set('graphics_listen_addr_spice'):
+    if has_spice:
         listen_addrs['spice'] = str(
             migrate_data.graphics_listen_addr_spice)
     return listen_addrs
@@ -77,31 +94,40 @@ def serial_listen_ports(migrate_data):
 
 
 def get_updated_guest_xml(guest, migrate_data, get_volume_config):
-    xml_doc = etree.fromstring(guest.get_xml_desc(dump_migratable=True))
+    # The whole document is parsed into a tree on purpose: the complete
+    # guest XML is serialized back for the destination host, so an
+    # event-driven parse (e.g. iterparse) would still have to build and
+    # keep every element, and the domain XML is only a few KB anyway.
+    xml_doc = etree.fromstring(guest.get_xml_desc(dump_migratable=True),
+                               _PARSER)
     xml_doc = _update_graphics_xml(xml_doc, migrate_data)
     xml_doc = _update_serial_xml(xml_doc, migrate_data)
     xml_doc = _update_volume_xml(xml_doc, migrate_data, get_volume_config)
     xml_doc = _update_perf_events_xml(xml_doc, migrate_data)
-    return etree.tostring(xml_doc)
+    return etree.tostring(xml_doc, encoding='utf-8')
 
 
 def _update_graphics_xml(xml_doc, migrate_data):
     listen_addrs = graphics_listen_addrs(migrate_data)
+    if listen_addrs is None:
+        return xml_doc
 
     # change over listen addresses
-    for dev in xml_doc.findall('./devices/graphics'):
-        gr_type = dev.get('type')
-        listen_tag = dev.find('listen')
-        if gr_type in ('vnc', 'spice'):
-            if listen_tag is not None:
-                listen_tag.set('address', listen_addrs[gr_type])
-            if dev.get('listen') is not None:
-                dev.set('listen', listen_addrs[gr_type])
+    for dev in _GRAPHICS_XPATH(xml_doc):
+        addr = listen_addrs.get(dev.get('type'))
+        if addr is None:
+            continue
+        for listen_tag in _LISTEN_XPATH(dev):
+            listen_tag.set('address', addr)
+        if 'listen' in dev.attrib:
+            dev.set('listen', addr)
     return xml_doc
 
 
 def _update_serial_xml(xml_doc, migrate_data):
     listen_addr = serial_listen_addr(migrate_data)
+    if listen_addr is None:
+        return xml_doc
     listen_ports = serial_listen_ports(migrate_data)
 
     def set_listen_addr_and_port(source, listen_addr, serial_listen_ports):
@@ -110,21 +136,18 @@ def _update_serial_xml(xml_doc, migrate_data):
         # None. That's why we have to check for None in this method.
         if source.get('host') is not None:
             source.set('host', listen_addr)
-        device = source.getparent()
-        target = device.find("target")
-        if target is not None and source.get('service') is not None:
+        if source.get('service') is None:
+            return
+        for target in _TARGET_XPATH(source.getparent()):
             port_index = int(target.get('port'))
             # NOTE (markus_z): Previous releases might not give us the
             # ports yet, that's why we have this check here.
             if len(serial_listen_ports) > port_index:
                 source.set('service', str(serial_listen_ports[port_index]))
 
-    # This updates all "LibvirtConfigGuestSerial" devices
-    for source in xml_doc.findall("./devices/serial[@type='tcp']/source"):
-        set_listen_addr_and_port(source, listen_addr, listen_ports)
-
-    # This updates all "LibvirtConfigGuestConsole" devices
-    for source in xml_doc.findall("./devices/console[@type='tcp']/source"):
+    # This updates all "LibvirtConfigGuestSerial" and
+    # "LibvirtConfigGuestConsole" devices
+    for source in _SERIAL_CONSOLE_XPATH(xml_doc):
         set_listen_addr_and_port(source, listen_addr, listen_ports)
 
     return xml_doc
@@ -133,43 +156,46 @@ def _update_serial_xml(xml_doc, migrate_data):
 def _update_volume_xml(xml_doc, migrate_data, get_volume_config):
     """Update XML using device information of destination host."""
     migrate_bdm_info = migrate_data.bdms
+    if not migrate_bdm_info:
+        return xml_doc
 
     # Update volume xml
-    parser = etree.XMLParser(remove_blank_text=True)
-    disk_nodes = xml_doc.findall('./devices/disk')
-
-    bdm_info_by_serial = {x.serial: x for x in migrate_bdm_info}
-    for pos, disk_dev in enumerate(disk_nodes):
-        serial_source = disk_dev.findtext('serial')
-        bdm_info = bdm_info_by_serial.get(serial_source)
-        if (serial_source is None or
-            not bdm_info or not bdm_info.connection_info or
-            serial_source not in bdm_info_by_serial):
+    bdm_info_by_serial = {x.serial: x for x in migrate_bdm_info
+                          if x.connection_info}
+    for serial_source, bdm_info in bdm_info_by_serial.items():
+        if serial_source is None:
             continue
-        conf = get_volume_config(
-            bdm_info.connection_info, bdm_info.as_disk_info())
-        xml_doc2 = etree.XML(conf.to_xml(), parser)
-        serial_dest = xml_doc2.findtext('serial')
-
-        # Compare source serial and destination serial number.
-        # If these serial numbers match, continue the process.
-        if (serial_dest and (serial_source == serial_dest)):
-            LOG.debug("Find same serial number: pos=%(pos)s, "
-                      "serial=%(num)s",
-                      {'pos': pos, 'num': serial_source})
-            for cnt, item_src in enumerate(disk_dev):
+        # Only visit the disks of the guest which carry this serial
+        for disk_dev in _DISK_BY_SERIAL_XPATH(xml_doc, serial=serial_source):
+            conf = get_volume_config(
+                bdm_info.connection_info, bdm_info.as_disk_info())
+            xml_doc2 = conf.format_dom()
+            serial_dest = xml_doc2.findtext('serial')
+
+            # Compare source serial and destination serial number.
+            # If these serial numbers do not match, skip the disk.
+            if not serial_dest or serial_source != serial_dest:
+                continue
+            LOG.debug("Find same serial number: serial=%(num)s",
+                      {'num': serial_source})
+            # Index the destination items by tag once rather than searching
+            # the destination for every source item.
+            dst_by_tag = {}
+            for item_dst in xml_doc2:
+                dst_by_tag.setdefault(item_dst.tag, item_dst)
+            for item_src in list(disk_dev):
                 # If source and destination have same item, update
                 # the item using destination value.
-                for item_dst in xml_doc2.findall(item_src.tag):
-                    disk_dev.remove(item_src)
+                item_dst = dst_by_tag.pop(item_src.tag, None)
+                if item_dst is not None:
                     item_dst.tail = None
-                    disk_dev.insert(cnt, item_dst)
+                    disk_dev.replace(item_src, item_dst)
 
-            # If destination has additional items, thses items should be
+            # If destination has additional items, these items should be
             # added here.
             for item_dst in list(xml_doc2):
                 item_dst.tail = None
-                disk_dev.insert(cnt, item_dst)
+                disk_dev.append(item_dst)
     return xml_doc
 
 
@@ -182,7 +208,7 @@ def _update_perf_events_xml(xml_doc, migrate_data):
     if 'supported_perf_events' in migrate_data:
         supported_perf_events = migrate_data.supported_perf_events
 
-    perf_events = xml_doc.findall('./perf')
+    perf_events = _PERF_XPATH(xml_doc)
 
     # remove perf events from xml
     if not perf_events:
@@ -267,11 +293,12 @@ def should_abort(instance, now,
     if migration_status == 'running (post-copy)':
         return False
 
-    if (progress_timeout != 0 and
-            (now - progress_time) > progress_timeout):
-        LOG.warning("Live migration stuck for %d sec",
-                    (now - progress_time), instance=instance)
-        return True
+    if progress_timeout != 0:
+        stuck_time = now - progress_time
+        if stuck_time > progress_timeout:
+            LOG.warning("Live migration stuck for %d sec",
+                        stuck_time, instance=instance)
+            return True
 
     if (completion_timeout != 0 and
             elapsed > completion_timeout):
@@ -323,7 +350,7 @@ def update_downtime(guest, instance,
     :param guest: a nova.virt.libvirt.guest.Guest to set downtime for
     :param instance: a nova.objects.Instance
     :param olddowntime: current set downtime, or None
-    :param downtime_steps: list of downtime steps
+    :param downtime_steps: list of downtime steps, ordered by time marker
     :param elapsed: total time of migration in secs
 
     Determine if the maximum downtime needs to be increased
@@ -342,14 +369,13 @@ def update_downtime(guest, instance,
     LOG.debug("Current %(dt)s elapsed %(elapsed)d steps %(steps)s",
               {"dt": olddowntime, "elapsed": elapsed,
                "steps": downtime_steps}, instance=instance)
-    thisstep = None
-    for step in downtime_steps:
-        if elapsed > step[0]:
-            thisstep = step
-
-    if thisstep is None:
+    # The steps are ordered by time marker, so the current step is the
+    # last one whose marker is strictly lower than the elapsed time.
+    idx = bisect.bisect_left(downtime_steps, (elapsed,))
+    if idx == 0:
         LOG.debug("No current step", instance=instance)
         return olddowntime
+    thisstep = downtime_steps[idx - 1]
 
     if thisstep[1] == olddowntime:
         LOG.debug("Downtime does not need to change",
@@ -379,7 +405,8 @@ def save_stats(instance, migration, info, remaining):
     :param remaining: percentage data remaining to transfer
 
     Update the migration and instance objects with
-    the latest available migration stats
+    the latest available migration stats. The instance
+    is only saved when its progress has changed.
     """
 
     # The fully detailed stats
@@ -391,9 +418,13 @@ def save_stats(instance, migration, info, remaining):
     migration.disk_remaining = info.disk_remaining
     migration.save()
 
-    # The coarse % completion stats
-    instance.progress = 100 - remaining
-    instance.save()
+    # The coarse % completion stats, which usually stay the same
+    # across several polls so avoid a needless instance update
+    progress = 100 - remaining
+    if (not instance.obj_attr_is_set('progress') or
+            instance.progress != progress):
+        instance.progress = progress
+        instance.save()
 
 
 def trigger_postcopy_switch(guest, instance, migration):